@@ -0,0 +1,46 @@
+"""DB-Modelle.
+
+Eigenes Modul statt im Streamlit-Script: das Script läuft bei jedem Rerun neu, ein
+importiertes Modul nur einmal pro Prozess. So bleiben Tabellen/Mapper dieselben Objekte
+und SQLAlchemys Statement-Cache (compiled cache, lambda_stmt) greift über Reruns hinweg.
+"""
+from datetime import datetime
+
+from sqlalchemy import Integer, String, Text, ForeignKey, DateTime, Index, func, text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+class Base(DeclarativeBase):
+    pass
+
+class User(Base):
+    __tablename__ = "users"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
+
+class WorkSession(Base):
+    __tablename__ = "sessions"
+    __table_args__ = (Index("ix_sessions_user_end", "user_id", "end_ts"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    start_ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    end_ts: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    minutes: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+class Adjustment(Base):
+    __tablename__ = "adjustments"
+    __table_args__ = (Index("ix_adj_user_created", "user_id", "created_ts"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    minutes: Mapped[int] = mapped_column(Integer, nullable=False)
+    reason: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class Log(Base):
+    __tablename__ = "logs"
+    __table_args__ = (Index("ix_logs_user_id_desc", "user_id", text("id DESC")),)  # Logbuch: neueste zuerst
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # start | stop | adjust
+    minutes: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    details: Mapped[str | None] = mapped_column(Text, nullable=True)
@@ -1,20 +1,34 @@
+import io
+import itertools
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import pandas as pd
+import pyarrow as pa
+from dateutil.relativedelta import relativedelta
 import streamlit as st
-from sqlalchemy import (
-    create_engine, Integer, String, Text, ForeignKey,
-    select
-)
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session, relationship
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import Integer, cast, create_engine, select, update, func, text, lambda_stmt, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import Base, User, WorkSession, Adjustment, Log
 
 # ---------------- CONFIG ----------------
 TZ = ZoneInfo("Europe/Zurich")
-ALLOWED_USERS = [n.strip() for n in os.environ.get("ALLOWED_USERS", "Elena,Noah,Gast").split(",") if n.strip()]
+TS_FMT = "%Y-%m-%d %H:%M:%S"
+MONTH_HISTORY = 24  # Monate in der Monatsübersicht (inkl. aktuellem)
+LOG_PAGE_SIZE = 50
+LOG_EXPORT_LIMIT = 500
+CACHE_TTL = 60  # Sekunden; Obergrenze für veraltete Cache-Einträge, falls der data_version-Key nicht greift
+SCHEMA_VERSION = "zeiterfassung-schema-1"  # erhöhen, wenn init_schema neue Schritte bekommt
+ALLOWED_USERS = tuple(n.strip() for n in os.environ.get("ALLOWED_USERS", "Elena,Noah,Gast").split(",") if n.strip())
+_ALLOWED_SET = frozenset(ALLOWED_USERS)
 DATABASE_URL = os.environ.get("DATABASE_URL") or st.secrets.get("DATABASE_URL")
+# Läuft die DB hinter einem Pooler im Transaction-Mode (pgbouncer, Supabase :6543)?
+DB_TRANSACTION_POOLER = os.environ.get("DB_TRANSACTION_POOLER", "").lower() in ("1", "true", "yes")
 
 # ---- Fix: erzwinge psycopg (v3) Treiber ----
 if DATABASE_URL.startswith("postgres://"):
@@ -27,64 +41,90 @@ if not DATABASE_URL:
     st.stop()
     raise RuntimeError("Set DATABASE_URL via environment or Streamlit secrets.")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=1800,
-    pool_size=5,
-    max_overflow=5,
-)
-
-# ---------------- DB MODELS ----------------
-class Base(DeclarativeBase):
-    pass
-
-class User(Base):
-    __tablename__ = "users"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    name: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
-    sessions: Mapped[list["WorkSession"]] = relationship(back_populates="user", cascade="all, delete-orphan")
-    adjustments: Mapped[list["Adjustment"]] = relationship(back_populates="user", cascade="all, delete-orphan")
-    logs: Mapped[list["Log"]] = relationship(back_populates="user", cascade="all, delete-orphan")
-
-class WorkSession(Base):
-    __tablename__ = "sessions"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
-    start_ts: Mapped[str] = mapped_column(String(19), nullable=False)  # "YYYY-MM-DD HH:MM:SS"
-    end_ts: Mapped[str | None] = mapped_column(String(19), nullable=True)
-    minutes: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    user: Mapped[User] = relationship(back_populates="sessions")
-
-class Adjustment(Base):
-    __tablename__ = "adjustments"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
-    minutes: Mapped[int] = mapped_column(Integer, nullable=False)
-    reason: Mapped[str | None] = mapped_column(Text, nullable=True)
-    created_ts: Mapped[str] = mapped_column(String(19), nullable=False)
-    user: Mapped[User] = relationship(back_populates="adjustments")
-
-class Log(Base):
-    __tablename__ = "logs"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
-    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # start | stop | adjust
-    minutes: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    ts: Mapped[str] = mapped_column(String(19), nullable=False)
-    details: Mapped[str | None] = mapped_column(Text, nullable=True)
-    user: Mapped[User] = relationship(back_populates="logs")
-
-# Create tables + Index (aktive Session pro User)
-with engine.begin() as conn:
-    Base.metadata.create_all(conn)
-    conn.exec_driver_sql(
-        """
-        CREATE UNIQUE INDEX IF NOT EXISTS uq_active_session_per_user
-        ON sessions (user_id)
-        WHERE end_ts IS NULL;
-        """
+@st.cache_resource
+def get_engine():
+    """Ein Engine (inkl. Connection-Pool) pro Prozess, geteilt von allen Sessions/Reruns."""
+    engine = create_engine(
+        DATABASE_URL,
+        # kein pool_pre_ping (Extra-Roundtrip pro Checkout); stattdessen Verbindungen
+        # deutlich vor dem Idle-Timeout der DB/des Poolers erneuern
+        pool_recycle=300,
+        pool_size=10,
+        max_overflow=20,
+        pool_timeout=10,
+        pool_use_lifo=True,  # wenige "warme" Verbindungen wiederverwenden, Overflow darf auslaufen
+        # psycopg bereitet wiederholte Statements serverseitig vor; das verträgt ein
+        # Transaction-Pooler nicht (nächste Transaktion landet evtl. auf anderer Backend-Verbindung)
+        connect_args={"prepare_threshold": None} if DB_TRANSACTION_POOLER else {},
     )
+    init_schema(engine)
+    return engine
+
+@st.cache_resource
+def get_sessionmaker():
+    """Session-Factory für Schreibpfade; Lesepfade nutzen Core (`get_engine().connect()`)."""
+    return sessionmaker(get_engine(), expire_on_commit=False, autoflush=False)
+
+@st.cache_resource
+def _data_versions() -> tuple[dict[int, int], itertools.count]:
+    """Datenstand pro User, prozessweit (gilt für alle Tabs/Browser-Sessions dieses Prozesses).
+
+    Bei mehreren Instanzen (z. B. zwei Fly-Machines) sieht eine Instanz die Bumps der anderen
+    nicht; dafür haben die gecachten Lesepfade zusätzlich CACHE_TTL.
+    """
+    return {}, itertools.count(1)
+
+def data_version(user_id: int) -> int:
+    """Cache-Key der gecachten Lesepfade; ändert sich nur durch Start/Stop/Buchen."""
+    return _data_versions()[0].get(user_id, 0)
+
+def bump_data_version(user_id: int):
+    versions, counter = _data_versions()
+    versions[user_id] = next(counter)  # next() ist atomar, parallele Bumps ergeben nie denselben Wert
+
+# Create tables + Index (aktive Session pro User) – einmal pro Prozess, aus get_engine()
+def init_schema(engine):
+    with engine.begin() as conn:
+        # Schema schon aktuell? -> eine Abfrage statt aller DDL-Schritte (Marker als Tabellenkommentar)
+        if conn.scalar(text("SELECT obj_description(to_regclass('users'), 'pg_class')")) == SCHEMA_VERSION:
+            return
+        Base.metadata.create_all(conn)
+        # create_all legt Indizes nur mit neuen Tabellen an -> für bestehende Tabellen nachziehen
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        # durch die zusammengesetzten Indizes oben abgedeckt
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_sessions_user_id, ix_adjustments_user_id, ix_logs_user_id")
+        conn.exec_driver_sql(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_active_session_per_user
+            ON sessions (user_id)
+            WHERE end_ts IS NULL;
+            """
+        )
+        # Migration: frühere String(19)-Spalten ("YYYY-MM-DD HH:MM:SS", lokale Zeit) -> timestamptz
+        legacy_columns = conn.execute(
+            text(
+                """
+                SELECT table_name, column_name FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND data_type = 'character varying'
+                  AND (table_name, column_name) IN (
+                    ('sessions', 'start_ts'), ('sessions', 'end_ts'),
+                    ('adjustments', 'created_ts'), ('logs', 'ts')
+                  )
+                """
+            )
+        ).all()
+        for table, column in legacy_columns:
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamptz "
+                f"USING {column}::timestamp AT TIME ZONE '{TZ.key}'"
+            )
+        # DB-seitige Zeitstempel (server_default) auch für bestehende Tabellen, nach der Migration
+        for table, column in (("sessions", "start_ts"), ("adjustments", "created_ts"), ("logs", "ts")):
+            conn.exec_driver_sql(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT now()")
+        conn.exec_driver_sql(f"COMMENT ON TABLE users IS '{SCHEMA_VERSION}'")
 
 # ---------------- HELPERS ----------------
 def safe_commit(session: Session):
@@ -95,20 +135,12 @@ def safe_commit(session: Session):
         raise
 
 def now_local() -> datetime:
-    return datetime.now(TZ)
-
-def minutes_between(start_iso: str, end_iso: str) -> int:
-    start = datetime.fromisoformat(start_iso).replace(tzinfo=TZ)
-    end = datetime.fromisoformat(end_iso).replace(tzinfo=TZ)
-    delta = end - start
-    total_seconds = int(delta.total_seconds())
-    mins, secs = divmod(total_seconds, 60)
-    minutes = mins + (1 if secs >= 30 else 0)  # >=30s aufrunden
-    return max(0, minutes)
-
-def seconds_between(start_iso: str, end_iso: str) -> int:
-    start = datetime.fromisoformat(start_iso).replace(tzinfo=TZ)
-    end = datetime.fromisoformat(end_iso).replace(tzinfo=TZ)
+    return datetime.now(TZ).replace(microsecond=0)
+
+def fmt_ts(dt: datetime) -> str:
+    return dt.astimezone(TZ).strftime(TS_FMT)
+
+def seconds_between(start: datetime, end: datetime) -> int:
     return max(0, int((end - start).total_seconds()))
 
 def month_key(dt: datetime) -> str:
@@ -127,75 +159,101 @@ def month_label_from_key(key: str) -> str:
     name = _DE_MONTHS[m-1]
     return f"{name} {y%100:02d}"
 
-def get_or_create_user(name: str) -> User:
-    with Session(engine) as s:
-        user = s.scalar(select(User).where(User.name == name))
-        if not user:
-            user = User(name=name)
-            s.add(user)
-            safe_commit(s)
-            s.refresh(user)
-        return user
-
-def active_session(user_id: int) -> WorkSession | None:
-    with Session(engine) as s:
-        return s.scalar(
-            select(WorkSession)
+@st.cache_resource
+def get_user_ids(names: tuple[str, ...]) -> dict[str, int]:
+    """Name -> User-ID; legt die (feste) Namensliste einmal pro Prozess an, Login braucht danach keine DB."""
+    with get_engine().begin() as conn:
+        if names:
+            conn.execute(
+                pg_insert(User)
+                .values([{"name": n} for n in names])
+                .on_conflict_do_nothing(index_elements=[User.name])
+            )
+        rows = conn.execute(select(User.name, User.id).where(User.name.in_(names))).all()
+    return dict(rows)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=1000, show_spinner=False)
+def active_session(user_id: int, version: int) -> tuple[int, datetime] | None:
+    """(id, start_ts) der laufenden Session oder None; `version` = data_version (Cache-Key)."""
+    with get_engine().connect() as conn:
+        row = conn.execute(lambda_stmt(
+            lambda: select(WorkSession.id, WorkSession.start_ts)
             .where(WorkSession.user_id == user_id, WorkSession.end_ts.is_(None))
             .order_by(WorkSession.id.desc())
+            .limit(1)
+        )).first()
+    return tuple(row) if row else None
+
+def add_log(s: Session, user_id: int, kind: str, minutes: int | None = None, details: str | None = None):
+    """Logeintrag in der offenen Session anlegen; committet wird zusammen mit der Aktion."""
+    s.add(
+        Log(
+            user_id=user_id,
+            kind=kind,
+            minutes=minutes,
+            details=details or "",
         )
+    )
 
-def add_log(user_id: int, kind: str, minutes: int | None = None, details: str | None = None):
-    with Session(engine) as s:
-        s.add(
-            Log(
-                user_id=user_id,
-                kind=kind,
-                minutes=minutes,
-                ts=now_local().strftime("%Y-%m-%d %H:%M:%S"),
-                details=details or "",
-            )
-        )
-        safe_commit(s)
-
-def month_totals(user_id: int):
-    """Return list[(YYYY-MM, minutes)] from finished sessions + adjustments grouped by month."""
-    with Session(engine) as s:
-        sessions = s.scalars(
-            select(WorkSession).where(
-                WorkSession.user_id == user_id, WorkSession.end_ts.is_not(None)
-            )
-        ).all()
-        adjustments = s.scalars(
-            select(Adjustment).where(Adjustment.user_id == user_id)
+@st.cache_data(ttl=CACHE_TTL, max_entries=1000, show_spinner=False)
+def month_totals(user_id: int, version: int):
+    """Return list[(YYYY-MM, minutes)] from finished sessions + adjustments grouped by month.
+
+    `version` = data_version (Cache-Key).
+    """
+    # Sessions + Anpassungen in einer Abfrage (UNION ALL), Gruppierung nach Monat in lokaler Zeit
+    cutoff = now_local().replace(day=1, hour=0, minute=0, second=0) - relativedelta(months=MONTH_HISTORY - 1)
+    entries = union_all(
+        select(func.timezone(TZ.key, WorkSession.end_ts).label("ts"), WorkSession.minutes)
+        .where(WorkSession.user_id == user_id, WorkSession.end_ts >= cutoff),
+        select(func.timezone(TZ.key, Adjustment.created_ts), Adjustment.minutes)
+        .where(Adjustment.user_id == user_id, Adjustment.created_ts >= cutoff),
+    ).subquery()
+    month = func.to_char(entries.c.ts, "YYYY-MM").label("m")
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            select(month, func.coalesce(func.sum(entries.c.minutes), 0))
+            .group_by(month)
+            .order_by(month.desc())
         ).all()
-    totals: dict[str, int] = {}
-    for row in sessions:
-        end = datetime.fromisoformat(row.end_ts).replace(tzinfo=TZ)
-        k = month_key(end)
-        totals[k] = totals.get(k, 0) + int(row.minutes or 0)
-    for a in adjustments:
-        ts = datetime.fromisoformat(a.created_ts).replace(tzinfo=TZ)
-        k = month_key(ts)
-        totals[k] = totals.get(k, 0) + int(a.minutes)
-    return sorted(totals.items(), key=lambda kv: kv[0], reverse=True)
-
-def month_minutes(user_id: int) -> int:
-    key = month_key(now_local())
-    for k, v in month_totals(user_id):
-        if k == key:
-            return v
-    return 0
+    return [(k, int(mins)) for k, mins in rows]
+
+def month_minutes(user_id: int, version: int) -> int:
+    # aus dem (gecachten) Monats-Aggregat statt eigener Abfrage
+    return dict(month_totals(user_id, version)).get(month_key(now_local()), 0)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=1000, show_spinner=False)
+def get_logs_cached(user_id: int, limit: int, offset: int, version: int) -> pd.DataFrame:
+    """Logbuch (ts, kind, minutes, details), neueste zuerst; `version` = data_version (Cache-Key)."""
+    stmt = lambda_stmt(
+        lambda: select(Log.ts, Log.kind, Log.minutes, Log.details)
+        .where(Log.user_id == user_id)
+        .order_by(Log.id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    # Arrow-Spalten statt Python-Objekte pro Zelle; fertiges Frame cachen
+    with get_engine().connect() as conn:
+        df_log = pd.read_sql(stmt, conn, dtype_backend="pyarrow")
+    df_log["ts"] = pd.to_datetime(df_log["ts"], utc=True).dt.tz_convert(TZ).dt.strftime(TS_FMT)
+    return df_log
 
 def fmt_hms(total_seconds: int) -> str:
-    td = timedelta(seconds=total_seconds)
-    hours = td.days * 24 + td.seconds // 3600
-    minutes = (td.seconds % 3600) // 60
-    seconds = td.seconds % 60
+    hours, rest = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
+@st.cache_data(ttl=CACHE_TTL, max_entries=1000, show_spinner=False)
+def csv_bytes(_df: pd.DataFrame, file_name: str, version: int) -> bytes:
+    """CSV für Download-Buttons; `_df` wird nicht gehasht, Cache-Key ist (file_name, data_version)."""
+    # direkt in einen Byte-Puffer schreiben statt str erzeugen und danach encodieren
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
 # ---------- Timer UI ----------
-def static_timer_html(time_str: str, color: str = "#9AA0A6", height: int = 70):
+def static_timer_html(time_str: str, color: str = "#9AA0A6"):
+    """Statische Anzeige braucht kein Script -> direkt ins DOM statt eigenes iframe-Component."""
     html = f"""
     <div style="font-size:2rem;
                 font-weight:600;
@@ -204,12 +262,11 @@ def static_timer_html(time_str: str, color: str = "#9AA0A6", height: int = 70):
       {time_str}
     </div>
     """
-    st.components.v1.html(html, height=height)
+    st.markdown(html.strip(), unsafe_allow_html=True)
 
-def live_timer_html(start_iso: str, color: str = "#00FFAA", height: int = 70):
+def live_timer_html(start: datetime, color: str = "#00FFAA", height: int = 70):
     """Clientseitiger HH:MM:SS-Timer ohne Streamlit-Rerun (TZ-sicher)."""
-    start_dt = datetime.fromisoformat(start_iso).replace(tzinfo=TZ)
-    start_js = start_dt.isoformat()
+    start_ms = int(start.timestamp() * 1000)  # Epoch-ms: eindeutig für new Date(), unabhängig von Mikrosekunden
     html = (
         """
         <div id=\"tt-timer\" 
@@ -219,7 +276,7 @@ def live_timer_html(start_iso: str, color: str = "#00FFAA", height: int = 70):
         <script>
           (function(){
             const pad = (n) => String(n).padStart(2,'0');
-            const start = new Date('START_JS');
+            const start = new Date(START_MS);
             function tick(){
               const now = new Date();
               let sec = Math.floor((now - start)/1000);
@@ -234,7 +291,7 @@ def live_timer_html(start_iso: str, color: str = "#00FFAA", height: int = 70):
           })();
         </script>
         """
-        .replace("START_JS", start_js)
+        .replace("START_MS", str(start_ms))
         .replace("COLOR", color)
     )
     st.components.v1.html(html, height=height)
@@ -290,6 +347,101 @@ def collapse_sidebar():
         unsafe_allow_html=True,
     )
 
+# ---------- Aktionen (Widget-Callbacks) ----------
+# Callbacks laufen vor dem Rerun, den das Widget ohnehin auslöst -> kein zusätzliches st.rerun()
+def remember_active(user_id: int, active: tuple[int, datetime] | None):
+    """Laufende Session mit Datenstand und Ladezeitpunkt in der Browser-Session merken."""
+    st.session_state["active"] = (data_version(user_id), time.monotonic(), active)
+
+def start_session(user_id: int):
+    try:
+        with get_sessionmaker()() as s:
+            work_session = WorkSession(user_id=user_id)
+            s.add(work_session)
+            s.flush()  # start_ts (DB-Default) kommt per INSERT … RETURNING zurück
+            add_log(s, user_id, "start", details=f"Start um {fmt_ts(work_session.start_ts)}")
+            safe_commit(s)
+    except IntegrityError:
+        # läuft bereits (z. B. in anderem Tab gestartet) → Status neu aus der DB laden
+        bump_data_version(user_id)
+        st.toast("Zeiterfassung läuft bereits.")
+        return
+    bump_data_version(user_id)
+    remember_active(user_id, (work_session.id, work_session.start_ts))
+    st.toast("Zeiterfassung gestartet.")
+
+def stop_session(user_id: int, session_id: int):
+    # Ende und Minuten mit derselben DB-Uhr wie start_ts (server_default now()); ab 30 s aufrunden
+    elapsed = cast(func.floor(func.extract("epoch", func.now() - WorkSession.start_ts)), Integer)
+    with get_sessionmaker()() as s:
+        row = s.execute(
+            update(WorkSession)
+            .where(WorkSession.id == session_id, WorkSession.end_ts.is_(None))
+            .values(end_ts=func.now(), minutes=(elapsed + 30) // 60)
+            .returning(WorkSession.start_ts, WorkSession.end_ts, WorkSession.minutes)
+        ).first()
+        if row is not None:
+            start_ts, end_ts, mins = row
+            secs = seconds_between(start_ts, end_ts)
+            add_log(s, user_id, "stop", minutes=mins, details=f"Stop um {fmt_ts(end_ts)} (+{fmt_hms(secs)})")
+            safe_commit(s)
+
+    bump_data_version(user_id)
+    if row is None:
+        # bereits gestoppt (z. B. in anderem Tab) -> nichts verbuchen, Status neu aus der DB laden
+        st.session_state.pop("active", None)
+        st.toast("Zeiterfassung war bereits gestoppt.")
+        return
+    remember_active(user_id, None)
+    st.toast(f"Gestoppt: {fmt_hms(secs)} verbucht.")
+
+# ---------- Fragments ----------
+@st.fragment
+def adjustment_form(user_id: int):
+    """Eingaben lösen nur einen Rerun dieses Fragments aus; nach dem Buchen läuft die ganze App neu."""
+    st.subheader("Manuelle Anpassung")
+    delta = st.number_input("±Minuten (z. B. -30 oder 30)", step=1, value=0)
+    reason = st.text_input("Kommentar (optional)", value="")
+    if st.button("Buchen", help="Manuell Zeit hinzufügen oder abziehen"):
+        if delta == 0:
+            st.warning("Bitte eine von 0 verschiedene Minutenanzahl eingeben.")
+        else:
+            with get_sessionmaker()() as s:
+                s.add(Adjustment(user_id=user_id, minutes=int(delta), reason=reason.strip()))
+                add_log(s, user_id, "adjust", minutes=int(delta), details=reason or "Manuelle Anpassung")
+                safe_commit(s)
+            bump_data_version(user_id)
+            st.toast(f"{'+' if delta>0 else ''}{int(delta)} Minuten verbucht.")
+            st.rerun(scope="app")
+
+def set_log_page(page: int):
+    st.session_state["log_page"] = page
+
+@st.fragment
+def logbook(user: dict):
+    """Blättern lädt nur diese Seite neu, nicht die ganze App."""
+    st.subheader("Logbuch")
+    version = data_version(user["id"])
+    page = st.session_state.setdefault("log_page", 0)
+    # eine Zeile mehr holen, um zu wissen, ob es ältere Einträge gibt
+    df_log = get_logs_cached(user["id"], LOG_PAGE_SIZE + 1, page * LOG_PAGE_SIZE, version)
+    st.dataframe(df_log.head(LOG_PAGE_SIZE), use_container_width=True, hide_index=True)
+
+    nav_newer, nav_page, nav_older = st.columns([1, 2, 1])
+    nav_newer.button("◀ Neuere", disabled=page == 0, on_click=set_log_page, args=(page - 1,))
+    nav_page.caption(f"Seite {page + 1}")
+    nav_older.button("Ältere ▶", disabled=len(df_log) <= LOG_PAGE_SIZE, on_click=set_log_page, args=(page + 1,))
+
+    df_export = get_logs_cached(user["id"], LOG_EXPORT_LIMIT, 0, version)
+    if not df_export.empty:
+        file_name = f"logs_{user['name']}.csv"
+        st.download_button(
+            "CSV: Logbuch",
+            csv_bytes(df_export, file_name, version),
+            file_name=file_name,
+            mime="text/csv",
+        )
+
 # ---------------- STREAMLIT UI ----------------
 st.set_page_config(page_title="Zeiterfassung", page_icon="⏱️", layout="wide")
 st.title("⏱️ Zeiterfassung")
@@ -298,9 +450,13 @@ st.title("⏱️ Zeiterfassung")
 st.sidebar.header("Login")
 name = st.sidebar.selectbox("Name", ALLOWED_USERS, index=0, key="name_select")
 if st.sidebar.button("Einloggen", help="Logge dich mit deinem Namen ein"):
-    user_obj = get_or_create_user(name)
-    st.session_state["user"] = {"id": user_obj.id, "name": user_obj.name}
-    st.success(f"Hallo {user_obj.name}!")
+    if name not in _ALLOWED_SET:
+        st.sidebar.error("Unbekannter Name.")
+        st.stop()
+    st.session_state["user"] = {"id": get_user_ids(ALLOWED_USERS)[name], "name": name}
+    st.session_state.pop("active", None)
+    st.session_state.pop("log_page", None)
+    st.success(f"Hallo {name}!")
     collapse_sidebar()  # 👉 NEU: direkt nach Login einklappen
 
 user = st.session_state.get("user")
@@ -308,96 +464,68 @@ if not user:
     st.info("Bitte links deinen Namen wählen und **Einloggen**.")
     st.stop()
 
+# einmal pro Rerun (muss bei jedem Rerun neu gesendet werden, sonst verschwindet das CSS)
+center_dataframes()
+
 col1, col2 = st.columns([1, 1])
 
 with col1:
     st.subheader(f"Hallo {user['name']} 👋")
 
-    s_active = active_session(user["id"])
+    # laufende Session pro Browser-Session merken; neu laden, wenn sich der Datenstand geändert hat
+    # (Start/Stop in anderem Tab) oder nach CACHE_TTL (Änderungen auf einer anderen Instanz)
+    version = data_version(user["id"])
+    known_version, loaded_at, s_active = st.session_state.get("active", (None, 0.0, None))
+    if known_version != version or time.monotonic() - loaded_at > CACHE_TTL:
+        s_active = active_session(user["id"], version)
+        remember_active(user["id"], s_active)
     st.markdown("**Laufzeit**")
     if s_active:
-        st.caption(f"Läuft seit: {s_active.start_ts}")
-        live_timer_html(s_active.start_ts, color="#22c55e")
-
-        if not st.toggle("Zeiterfassung läuft", value=True):
-            end_ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-            secs = seconds_between(s_active.start_ts, end_ts)
-            mins = minutes_between(s_active.start_ts, end_ts)
-
-            with Session(engine) as s:
-                obj = s.get(WorkSession, s_active.id)
-                obj.end_ts = end_ts
-                obj.minutes = mins
-                safe_commit(s)
+        session_id, start_ts = s_active
+        st.caption(f"Läuft seit: {fmt_ts(start_ts)}")
+        live_timer_html(start_ts, color="#22c55e")
 
-            add_log(user["id"], "stop", minutes=mins, details=f"Stop um {end_ts} (+{fmt_hms(secs)})")
-            st.success(f"Gestoppt: {fmt_hms(secs)} verbucht.")
-            st.rerun()
+        st.toggle(
+            "Zeiterfassung läuft", value=True,
+            on_change=stop_session, args=(user["id"], session_id),
+        )
     else:
         static_timer_html("00:00:00", color="#9AA0A6")
-        if st.toggle("Zeiterfassung starten", value=False):
-            ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-            with Session(engine) as s:
-                s.add(WorkSession(user_id=user["id"], start_ts=ts))
-                safe_commit(s)
-            add_log(user["id"], "start", details=f"Start um {ts}")
-            st.success("Zeiterfassung gestartet.")
-            st.rerun()
+        st.toggle("Zeiterfassung starten", value=False, on_change=start_session, args=(user["id"],))
 
     st.divider()
-    st.subheader("Manuelle Anpassung")
-    delta = st.number_input("±Minuten (z. B. -30 oder 30)", step=1, value=0)
-    reason = st.text_input("Kommentar (optional)", value="")
-    if st.button("Buchen", help="Manuell Zeit hinzufügen oder abziehen"):
-        if delta == 0:
-            st.warning("Bitte eine von 0 verschiedene Minutenanzahl eingeben.")
-        else:
-            ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-            with Session(engine) as s:
-                s.add(Adjustment(user_id=user["id"], minutes=int(delta), reason=reason.strip(), created_ts=ts))
-                safe_commit(s)
-            add_log(user["id"], "adjust", minutes=int(delta), details=reason or "Manuelle Anpassung")
-            st.success(f"{'+' if delta>0 else ''}{int(delta)} Minuten verbucht.")
-            st.rerun()
+    adjustment_form(user["id"])
 
 with col2:
     st.subheader("Monatsübersicht")
-    current = month_minutes(user["id"])
+    current = month_minutes(user["id"], version)
     st.metric("Aktueller Monat", f"{current//60:02d}:{current%60:02d} h")
 
-    data = month_totals(user["id"])
-    df = pd.DataFrame([
-        {"Monat": month_label_from_key(k), "Minuten": m, "Stunden": round(m/60, 2), "Std:Min": f"{m//60:02d}:{m%60:02d}"}
-        for k, m in data
-    ])
+    data = month_totals(user["id"], version)
+    # spaltenweise aufbauen, abgeleitete Spalten vektorisiert statt f-String pro Zeile
+    keys, minutes = zip(*data) if data else ((), ())
+    mins = pd.Series(minutes, dtype="int64")
+    df = pd.DataFrame({
+        "Monat": [month_label_from_key(k) for k in keys],
+        "Minuten": mins,
+        "Stunden": (mins / 60).round(2),
+        "Std:Min": (mins // 60).astype(str).str.zfill(2) + ":" + (mins % 60).astype(str).str.zfill(2),
+    }).astype({  # Arrow-Spalten wie im Logbuch, Typen fest (auch bei ganzen Stunden/leerer Tabelle)
+        "Monat": pd.ArrowDtype(pa.string()),
+        "Minuten": pd.ArrowDtype(pa.int64()),
+        "Stunden": pd.ArrowDtype(pa.float64()),
+        "Std:Min": pd.ArrowDtype(pa.string()),
+    })
 
-    center_dataframes()
     st.dataframe(df, use_container_width=True, hide_index=True)
     if not df.empty:
+        file_name = f"months_{user['name']}.csv"
         st.download_button(
             "CSV: Monate",
-            df.to_csv(index=False).encode("utf-8"),
-            file_name=f"months_{user['name']}.csv",
+            csv_bytes(df, file_name, version),
+            file_name=file_name,
             mime="text/csv",
         )
 
 st.divider()
-st.subheader("Logbuch")
-with Session(engine) as s:
-    logs = s.execute(
-        select(Log.ts, Log.kind, Log.minutes, Log.details)
-        .where(Log.user_id == user["id"]) 
-        .order_by(Log.id.desc())
-        .limit(500)
-    ).all()
-
-df_log = pd.DataFrame(logs, columns=["ts", "kind", "minutes", "details"])
-center_dataframes()
-st.dataframe(df_log, use_container_width=True, hide_index=True)
-if not df_log.empty:
-    st.download_button(
-        "CSV: Logbuch",
-        df_log.to_csv(index=False).encode("utf-8"),
-        file_name=f"logs_{user['name']}.csv",
-        mime="text/csv",
-    )
+logbook(user)